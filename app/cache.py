@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+import hashlib
+import time
+
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+
+
+@lru_cache(maxsize=None)
+def get_adapter(model) -> TypeAdapter:
+    return TypeAdapter(model)
+
+
+class ResponseCache:
+    """
+    In-process TTL/LRU cache of serialized GET responses.
+
+    Every entry carries an ETag, so a poll with a matching `If-None-Match`
+    header gets a 304 without the body being loaded or serialized again.
+    Endpoints that write data invalidate the keys they affect, on every worker
+    through the notification broker. An invalidation published while a
+    worker's broker connection is down is lost; the TTL bounds how long that
+    worker may then serve the old response.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, bytes, str]] = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: str) -> tuple[bytes, str] | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, body, etag = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return body, etag
+
+    def set(self, key: str, body: bytes) -> str:
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, body, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return etag
+
+    def invalidate(self, *keys: str):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @staticmethod
+    def respond(request: Request, body: bytes, etag: str) -> Response:
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+    def lookup(self, key: str, request: Request) -> Response | None:
+        """Get the cached response for a key, or None on a cache miss."""
+        cached = self.get(key)
+        if cached is None:
+            return None
+        return self.respond(request, *cached)
+
+    def store(self, key: str, request: Request, data, model) -> Response:
+        """Serialize data with its response model, cache it and build the response."""
+        adapter = get_adapter(model)
+        body = adapter.dump_json(adapter.validate_python(data, from_attributes=True))
+        etag = self.set(key, body)
+        return self.respond(request, body, etag)
+
+
+cache = ResponseCache()
@@ -0,0 +1,154 @@
+"""
+Streaming export of graded submissions.
+
+Rows are read from the database with a server-side cursor and written out
+chunk by chunk, so memory stays constant whatever the number of submissions.
+
+Usage:
+    python -m app.export M11 --format csv --output M11.csv
+"""
+from itertools import islice
+from typing import Iterator
+import argparse
+import csv
+import io
+import re
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import models
+from .database import SessionLocal
+
+CHUNK_SIZE = 1000
+COLUMNS = ["email", "submitted_at", "score", "channel"]
+
+SECTION = re.compile(r"^(Not submitted|Incorrect|Partial|Correct|Issue): \d+$")
+QUESTION = re.compile(r"^  - Q(\d+) \(")
+
+
+def parse_verdicts(summary: str | None) -> dict[int, str]:
+    """Get the verdict of each question from a marking summary."""
+    verdicts = {}
+    section = None
+    for line in (summary or "").splitlines():
+        if match := SECTION.match(line):
+            section = match.group(1)
+            # Issues come last and are free text
+            if section == "Issue":
+                break
+        elif section and (match := QUESTION.match(line)):
+            verdicts[int(match.group(1))] = section
+    return verdicts
+
+
+def iter_rows(exam: str, questions: list[int]) -> Iterator[list[tuple]]:
+    """Yield chunks of (email, submitted_at, score, channel, *verdicts) rows of an exam."""
+    db = SessionLocal()
+    try:
+        # yield_per streams rows from a server-side cursor instead of loading them all
+        rows = iter(db.query(
+            models.Submission.email,
+            models.Submission.submitted_at,
+            models.Submission.score,
+            models.Submission.channel,
+            models.Submission.summary
+        ).filter(
+            models.Submission.exam_id == exam
+        ).order_by(models.Submission.id).yield_per(CHUNK_SIZE))
+
+        while partition := list(islice(rows, CHUNK_SIZE)):
+            chunk = []
+            for email, submitted_at, score, channel, summary in partition:
+                verdicts = parse_verdicts(summary)
+                chunk.append((email, submitted_at, score, channel,
+                              *(verdicts.get(q) for q in questions)))
+            yield chunk
+    finally:
+        db.close()
+
+
+def iter_csv(exam: str, questions: list[int]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS + [f"Q{q}" for q in questions])
+    for chunk in iter_rows(exam, questions):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+class ChunkSink:
+    """Write-only file object that hands out what was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_parquet(exam: str, questions: list[int]) -> Iterator[bytes]:
+    schema = pa.schema(
+        [("email", pa.string()), ("submitted_at", pa.timestamp("us", tz="UTC")),
+         ("score", pa.float64()), ("channel", pa.string())]
+        + [(f"Q{q}", pa.string()) for q in questions]
+    )
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        # One row group per chunk
+        for chunk in iter_rows(exam, questions):
+            if chunk:
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(column, type=field.type)
+                     for column, field in zip(zip(*chunk), schema)],
+                    schema=schema
+                ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+EXPORTERS = {
+    "csv": (iter_csv, "text/csv"),
+    "parquet": (iter_parquet, "application/vnd.apache.parquet"),
+}
+
+
+if __name__ == '__main__':
+    from .main import MARKER_CLASSES, get_questions
+
+    parser = argparse.ArgumentParser(description="Export graded submissions of an exam")
+    parser.add_argument("exam", choices=list(MARKER_CLASSES))
+    parser.add_argument("--format", choices=list(EXPORTERS), default="csv")
+    parser.add_argument("--output", help="Defaults to <exam>.<format>")
+    args = parser.parse_args()
+
+    exporter, _ = EXPORTERS[args.format]
+    output = args.output or f"{args.exam}.{args.format}"
+    with open(output, "wb") as f:
+        for data in exporter(args.exam, get_questions(args.exam)):
+            f.write(data)
+    print(f"Exported {args.exam} submissions to {output}")
@@ -1,25 +1,49 @@
-from fastapi import FastAPI, HTTPException, Depends, status, WebSocket
+from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from csautograde import M12Marker, M11Marker, M21Marker, M31Marker, create_summary
 from pytz import timezone
-
+from contextlib import asynccontextmanager
+from typing import Literal
+import asyncio
+import hashlib
+import json
+
+from sqlalchemy import insert, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from .schemas import Submission, SubmissionResponse, SubmissionHistory
 
 # Database
-from . import models
+from . import models, migrations
 from .database import engine, get_db
 from .websocket import manager
+from .cache import cache
+from .export import EXPORTERS
+from .profiler import ProfilerMiddleware, PROFILE_THRESHOLD_MS, store, tag_submission, profile_thread
 
 # Routers
-from .routers import exams
+from .routers import exams, profiles
+
+manager.on("invalidate_cache", lambda keys: cache.invalidate(*keys))
 
 models.Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Relay notifications published by any worker to this worker's sockets
+    await manager.start()
+    yield
+    await manager.stop()
+
 
 app = FastAPI(
     title='CS Exam Python Client',
     summary="Client for learner submissions",
-    version='0.0.10'
+    version='0.0.10',
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -30,6 +54,14 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+if PROFILE_THRESHOLD_MS:
+    app.add_middleware(
+        ProfilerMiddleware,
+        store=store,
+        threshold_ms=float(PROFILE_THRESHOLD_MS)
+    )
+    app.include_router(profiles.router)
+
 app.include_router(exams.router)
 
 
@@ -55,6 +87,83 @@ MARKER_CLASSES = {
     "M31": M31Marker
 }
 
+# Number of threads, each with its own marker, that grade one exam of a batch
+GRADING_WORKERS = 4
+
+
+def get_marker_class(exam: str):
+    """Get the marker class for an exam."""
+    MarkerClass = MARKER_CLASSES.get(exam.upper())
+    if MarkerClass is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid exam type: {exam}"
+        )
+    return MarkerClass
+
+
+def get_questions(exam: str) -> list[int]:
+    """Get the question numbers of an exam from its rubric."""
+    QUESTION_SCORES = get_marker_class(exam).QUESTION_SCORES
+    return sorted({question for questions in QUESTION_SCORES for question in questions})
+
+
+def grade_submissions(exam: str, submissions: list[Submission]) -> list[tuple[str, float, str]]:
+    """Grade submissions of the same exam with a single marker.
+
+    Returns:
+        The (summary, final score, solution version) of each submission, in order.
+    """
+    marker = get_marker_class(exam)()
+    results = []
+    for data in submissions:
+        marker.reset()
+        marker.mark_submission([question['answer'] for question in data.answers])
+        tag_submission(exam, data.email, marker.timings)
+        summary, final_score = create_summary(
+            marker.exam_name, marker.summary, marker.QUESTION_SCORES)
+        results.append((summary, final_score, marker.solution_version))
+    return results
+
+
+def hash_submission(data: Submission, solution_version: str) -> str:
+    """Hash the exam, answers and solution version of a submission.
+
+    Only line endings are normalized, anything else may change the grading.
+    """
+    answers = [
+        question['answer'].replace('\r\n', '\n')
+        if isinstance(question['answer'], str) else question['answer']
+        for question in data.answers
+    ]
+    payload = json.dumps(
+        [data.exam_id.upper(), answers, solution_version], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def find_graded(hashes: list[str], db: Session) -> dict[str, tuple[str, float, str]]:
+    """Find the summary, score and solution version of already graded submissions by content hash."""
+    # Identical submissions (e.g. all blank) share a hash, load a single one of them
+    first = db.query(func.min(models.Submission.id)).filter(
+        models.Submission.content_hash.in_(set(hashes))
+    ).group_by(models.Submission.content_hash)
+    graded = db.query(
+        models.Submission.content_hash,
+        models.Submission.summary,
+        models.Submission.score,
+        models.Submission.solution_version
+    ).filter(models.Submission.id.in_(first.scalar_subquery())).all()
+    return {content_hash: tuple(grading) for content_hash, *grading in graded}
+
+
+async def invalidate_submissions(*submissions: tuple[str, str]):
+    """Drop cached GET responses that include these (exam, email) submissions, on every worker."""
+    keys = [key for exam, email in submissions
+            for key in (f"submissions/{exam}/{email}", f"history/{email}")]
+    # This worker at once, so its next read sees the write; the others through the broker
+    cache.invalidate(*keys)
+    await manager.broadcast({"type": "invalidate_cache", "content": keys})
+
 
 def validate_email(email: str, db: Session):
     """Validate email exists in database."""
@@ -75,12 +184,16 @@ def validate_exam(exam: str, db: Session):
 
 
 @app.get("/submissions/{exam}/{email}", response_model=SubmissionResponse)
-async def get_submission(exam: str, email: str, db: Session = Depends(get_db)):
+async def get_submission(exam: str, email: str, request: Request, db: Session = Depends(get_db)):
     """Get a submission by email and exam.
 
     Returns:
         The submission.
     """
+    key = f"submissions/{exam}/{email}"
+    if cached := cache.lookup(key, request):
+        return cached
+
     validate_email(email, db)
     validate_exam(exam, db)
 
@@ -93,39 +206,59 @@ async def get_submission(exam: str, email: str, db: Session = Depends(get_db)):
         raise HTTPException(
             status_code=404, detail="No submission found for the provided email and exam.")
 
-    return assignment
+    return cache.store(key, request, assignment, SubmissionResponse)
 
 
 @app.post("/submissions", status_code=status.HTTP_201_CREATED)
-async def add_submission(data: Submission, db: Session = Depends(get_db)):
+async def add_submission(
+    data: Submission,
+    db: Session = Depends(get_db),
+    idempotency_key: str | None = Header(None)
+):
     """Add a new submission to the database.
 
+    A retried request with the same `Idempotency-Key` header is only added once,
+    and a resubmission of already graded answers reuses that grading.
+
     Returns:
         A message indicating the submission was added.
     """
-    # Generate marking summary
-    s = [question['answer'] for question in data.answers]
-
-    MarkerClass = MARKER_CLASSES.get(data.exam_id.upper())
-    if MarkerClass is None:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid exam type: {exams}"
-        )
+    if idempotency_key:
+        existing = db.query(models.Submission).filter(
+            models.Submission.idempotency_key == idempotency_key).first()
+        if existing:
+            return f"Added submission for {existing.email}"
 
-    marker = MarkerClass()
-    marker.mark_submission(s)
-
-    summary, final_score = create_summary(
-        marker.exam_name, marker.summary, marker.QUESTION_SCORES)
+    # Generate marking summary
+    MarkerClass = get_marker_class(data.exam_id)
+    content_hash = hash_submission(data, MarkerClass.get_solution_version())
+    graded = find_graded([content_hash], db).get(content_hash)
+    if graded is None:
+        # In a thread, so waiting for a replica connection never blocks the event loop
+        graded = (await asyncio.to_thread(
+            profile_thread(grade_submissions), data.exam_id, [data]))[0]
+    summary, final_score, solution_version = graded
 
     # Save to database
     submission = models.Submission(**data.model_dump())
     submission.summary = summary
     submission.score = final_score
+    submission.solution_version = solution_version
+    # Solutions may have been reloaded while grading
+    submission.content_hash = hash_submission(data, solution_version)
+    submission.idempotency_key = idempotency_key
 
     db.add(submission)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        # Only a concurrent retry with the same idempotency key is a replay
+        if idempotency_key and db.query(models.Submission).filter(
+                models.Submission.idempotency_key == idempotency_key).first():
+            return f"Added submission for {data.email}"
+        raise
+    await invalidate_submissions((submission.exam_id, submission.email))
 
     notification = {
         "type": "new_submission",
@@ -139,6 +272,88 @@ async def add_submission(data: Submission, db: Session = Depends(get_db)):
     return f"Added submission for {submission.email}"
 
 
+@app.post("/submissions/batch", status_code=status.HTTP_201_CREATED)
+async def add_submissions(data: list[Submission], db: Session = Depends(get_db)):
+    """Add many submissions at once, e.g. when a whole class submits at the deadline.
+
+    Each exam's submissions are split into chunks graded in parallel threads,
+    with one marker per chunk, then all
+    submissions are inserted in one transaction and announced in one event.
+    Answers that were already graded, or repeated within the batch, are
+    only graded once.
+
+    Returns:
+        A message indicating how many submissions were added.
+    """
+    versions = {
+        exam: get_marker_class(exam).get_solution_version()
+        for exam in {submission.exam_id for submission in data}
+    }
+    hashes = [hash_submission(submission, versions[submission.exam_id])
+              for submission in data]
+
+    exams = {exam.id: exam.name for exam in db.query(models.Exam).filter(
+        models.Exam.id.in_(versions)).all()}
+    for exam in versions:
+        if exam not in exams:
+            raise HTTPException(
+                status_code=404, detail=f"Exam {exam} not found")
+
+    graded = find_graded(hashes, db)
+    batches: dict[str, dict[str, Submission]] = {}
+    for submission, content_hash in zip(data, hashes):
+        if content_hash not in graded:
+            batches.setdefault(submission.exam_id, {})[content_hash] = submission
+
+    # Generate marking summaries, up to GRADING_WORKERS threads per exam
+    chunks = []
+    for exam, submissions in batches.items():
+        pending = list(submissions.items())
+        size = -(-len(pending) // GRADING_WORKERS)
+        chunks += [(exam, pending[i:i + size]) for i in range(0, len(pending), size)]
+
+    results = await asyncio.gather(*(
+        asyncio.to_thread(profile_thread(grade_submissions), exam,
+                          [submission for _, submission in chunk])
+        for exam, chunk in chunks
+    ))
+    for (_, chunk), summaries in zip(chunks, results):
+        graded.update(zip((content_hash for content_hash, _ in chunk), summaries))
+
+    # Save to database
+    rows = []
+    for submission, content_hash in zip(data, hashes):
+        summary, final_score, solution_version = graded[content_hash]
+        if solution_version != versions[submission.exam_id]:
+            # Solutions were reloaded while grading
+            content_hash = hash_submission(submission, solution_version)
+        rows.append({
+            **submission.model_dump(),
+            "summary": summary,
+            "score": final_score,
+            "solution_version": solution_version,
+            "content_hash": content_hash,
+        })
+
+    if not rows:
+        return "Added 0 submissions"
+
+    db.execute(insert(models.Submission), rows)
+    db.commit()
+    await invalidate_submissions(*((row["exam_id"], row["email"]) for row in rows))
+
+    notification = {
+        "type": "new_submissions",
+        "content": [
+            {"exam": exams[row["exam_id"]], "email": row["email"]}
+            for row in rows
+        ]
+    }
+    await manager.broadcast(notification)
+
+    return f"Added {len(rows)} submissions"
+
+
 @app.put("/channels/{exam}/{email}", response_model=SubmissionResponse)
 async def update_submission_channel(exam: str, email: str,  channel: str, db: Session = Depends(get_db)):
     validate_email(email, db)
@@ -154,6 +369,7 @@ async def update_submission_channel(exam: str, email: str,  channel: str, db: Se
             status_code=404, detail="No submission found for the provided email and exam.")
     submission.channel = channel
     db.commit()
+    await invalidate_submissions((exam, email))
 
     return submission
 
@@ -177,16 +393,40 @@ async def update_submission(exam: str, email: str, new_score: int, db: Session =
         raise HTTPException(
             status_code=404, detail="No submission found for the provided email and exam.")
     submission.score = new_score
+    # A manually adjusted score must not be reused for identical resubmissions
+    submission.content_hash = None
     db.commit()
+    await invalidate_submissions((exam, email))
 
     return submission
 
 
+@app.get("/exports/{exam}")
+async def export_submissions(exam: str, format: Literal["csv", "parquet"] = "csv", db: Session = Depends(get_db)):
+    """
+    Export every submission of an exam with its score, channel and the
+    verdict of each question, streamed as CSV or Parquet.
+    """
+    validate_exam(exam, db)
+    questions = get_questions(exam)
+
+    exporter, media_type = EXPORTERS[format]
+    return StreamingResponse(
+        exporter(exam, questions),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{exam}.{format}"'}
+    )
+
+
 @app.get("/history/{email}", response_model=list[SubmissionHistory])
-async def get_submission_history(email: str, db: Session = Depends(get_db)):
+async def get_submission_history(email: str, request: Request, db: Session = Depends(get_db)):
     """
     Get submission history for a learner by email.
     """
+    key = f"history/{email}"
+    if cached := cache.lookup(key, request):
+        return cached
+
     validate_email(email, db)
 
     # Query all submissions by the given email, ordered by the submission date
@@ -209,7 +449,7 @@ async def get_submission_history(email: str, db: Session = Depends(get_db)):
         for submission in submissions
     ]
 
-    return submission_history
+    return cache.store(key, request, submission_history, list[SubmissionHistory])
 
 
 # @app.get("/autograde")
@@ -0,0 +1,38 @@
+"""
+Schema upgrades for existing databases.
+
+`create_all` only creates missing tables, so columns added to an existing
+table are added here at startup. Every statement is idempotent, so it is
+safe to run on each start and from several workers at once on Postgres.
+"""
+from sqlalchemy import inspect, text
+
+# Columns added to submissions after the table was first created
+SUBMISSION_COLUMNS = [
+    ("solution_version", "VARCHAR"),
+    ("content_hash", "VARCHAR"),
+    ("idempotency_key", "VARCHAR"),
+]
+
+# Same names as the indexes create_all makes for a new table
+SUBMISSION_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_submissions_content_hash "
+    "ON submissions (content_hash)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_submissions_idempotency_key "
+    "ON submissions (idempotency_key)",
+]
+
+
+def upgrade(engine):
+    """Add missing columns and indexes to the submissions table."""
+    existing = {column["name"] for column in inspect(engine).get_columns("submissions")}
+    # SQLite has no IF NOT EXISTS for columns, the inspector check covers it
+    if_not_exists = "IF NOT EXISTS " if engine.dialect.name == "postgresql" else ""
+
+    with engine.begin() as conn:
+        for name, type_ in SUBMISSION_COLUMNS:
+            if name not in existing:
+                conn.execute(text(
+                    f"ALTER TABLE submissions ADD COLUMN {if_not_exists}{name} {type_}"))
+        for statement in SUBMISSION_INDEXES:
+            conn.execute(text(statement))
@@ -20,6 +20,14 @@ class Submission(Base):
     # Discord thread that this submission was posted in, added when call /submmit
     channel = Column(String)
 
+    # Version of the solution files the submission was graded against
+    solution_version = Column(String)
+
+    # Hash of (exam, answers, solution version), identical resubmissions reuse the grading
+    content_hash = Column(String, index=True)
+    # Client-supplied key so that retried requests do not add the submission twice
+    idempotency_key = Column(String, index=True, unique=True)
+
     exam = relationship("Exam", back_populates="submissions")
 
 
@@ -0,0 +1,157 @@
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from functools import wraps
+from pathlib import Path
+from uuid import uuid4
+import cProfile
+import hashlib
+import pstats
+import json
+import time
+import sys
+import os
+
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+# Profiling is opt-in: set PROFILE_THRESHOLD_MS to keep profiles of requests slower than it
+PROFILE_THRESHOLD_MS = os.environ.get('PROFILE_THRESHOLD_MS')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_MAX_CAPTURES = int(os.environ.get('PROFILE_MAX_CAPTURES', 50))
+
+# Tags of the request being profiled, filled in while grading
+capture_tags: ContextVar[dict | None] = ContextVar('capture_tags', default=None)
+# Profiles of the worker threads of the request being profiled
+thread_profiles: ContextVar[list | None] = ContextVar('thread_profiles', default=None)
+
+
+def tag_submission(exam: str, email: str, timings: dict):
+    """Attach a graded submission to the profile of the current request, if any."""
+    tags = capture_tags.get()
+    if tags is None:
+        return
+    tags.setdefault('submissions', []).append({
+        'exam': exam,
+        'email_hash': hashlib.sha256(email.encode()).hexdigest()[:12],
+        'timings': {question: round(seconds * 1000, 3) for question, seconds in timings.items()},
+    })
+
+
+def profile_thread(func):
+    """
+    Wrap a function run in a worker thread (e.g. with `asyncio.to_thread`) so
+    that it shows up in the profile of the current request, if any.
+
+    Before Python 3.12 cProfile only sees the thread that enabled it, so the
+    worker thread gets its own profiler, merged into the capture at the end of
+    the request. From 3.12 the request profiler already covers every thread.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profiles = thread_profiles.get()
+        if profiles is None or sys.version_info >= (3, 12):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            profiles.append(profile)
+    return wrapper
+
+
+class ProfileStore:
+    """
+    Bounded on-disk ring buffer of profiles. Each capture is a `.prof` file
+    (readable with pstats or snakeviz) with a `.json` file of its metadata.
+    The oldest captures are removed once `max_captures` is exceeded.
+    """
+
+    def __init__(self, directory: str, max_captures: int):
+        self.directory = Path(directory)
+        self.max_captures = max_captures
+
+    def save(self, profile: cProfile.Profile | pstats.Stats, metadata: dict) -> str:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        capture_id = f"{time.time_ns()}-{uuid4().hex[:8]}"
+        profile.dump_stats(self.directory / f"{capture_id}.prof")
+        with open(self.directory / f"{capture_id}.json", 'w') as f:
+            json.dump({'id': capture_id, **metadata}, f)
+
+        for old in self.list_ids()[:-self.max_captures]:
+            (self.directory / f"{old}.prof").unlink(missing_ok=True)
+            (self.directory / f"{old}.json").unlink(missing_ok=True)
+        return capture_id
+
+    def list_ids(self) -> list[str]:
+        """Capture ids from oldest to newest."""
+        if not self.directory.exists():
+            return []
+        return sorted(path.stem for path in self.directory.glob('*.json'))
+
+    def list(self) -> list[dict]:
+        captures = []
+        for capture_id in reversed(self.list_ids()):
+            with open(self.directory / f"{capture_id}.json", 'r') as f:
+                captures.append(json.load(f))
+        return captures
+
+    def path(self, capture_id: str) -> Path | None:
+        if capture_id not in self.list_ids():
+            return None
+        return self.directory / f"{capture_id}.prof"
+
+
+class ProfilerMiddleware(BaseHTTPMiddleware):
+    """
+    Profile requests with cProfile and keep the profile only when the request
+    takes longer than `threshold_ms`.
+
+    Only one request is profiled at a time, since a single profiler can be
+    active per process. Coroutines of other requests running while it awaits
+    show up in its profile as well. Work the request hands to threads is only
+    included when the threads run functions wrapped with `profile_thread`.
+    """
+
+    def __init__(self, app, store: ProfileStore, threshold_ms: float):
+        super().__init__(app)
+        self.store = store
+        self.threshold_ms = threshold_ms
+        self.active = False
+
+    async def dispatch(self, request: Request, call_next):
+        if self.active:
+            return await call_next(request)
+
+        self.active = True
+        tags = {}
+        profiles = []
+        token = capture_tags.set(tags)
+        profiles_token = thread_profiles.set(profiles)
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profile.enable()
+            response = await call_next(request)
+        finally:
+            profile.disable()
+            duration_ms = (time.perf_counter() - start) * 1000
+            capture_tags.reset(token)
+            thread_profiles.reset(profiles_token)
+            self.active = False
+
+        if duration_ms >= self.threshold_ms:
+            stats = pstats.Stats(profile)
+            for thread_profile in profiles:
+                stats.add(thread_profile)
+            self.store.save(stats, {
+                'method': request.method,
+                'path': request.url.path,
+                'status_code': response.status_code,
+                'duration_ms': round(duration_ms, 3),
+                'captured_at': datetime.now(timezone.utc).isoformat(),
+                **tags,
+            })
+        return response
+
+
+store = ProfileStore(PROFILE_DIR, PROFILE_MAX_CAPTURES)
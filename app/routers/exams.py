@@ -1,9 +1,10 @@
-from fastapi import status, Depends, APIRouter, HTTPException
+from fastapi import status, Depends, APIRouter, HTTPException, Request
 from sqlalchemy.orm import Session
 
 from .. import models
 from ..schemas import Exam
 from ..database import get_db
+from ..cache import cache
 
 from typing import List
 
@@ -25,32 +26,39 @@ async def add_exam(data: Exam, db: Session = Depends(get_db)):
     exam = models.Exam(**data.model_dump())
     db.add(exam)
     db.commit()
+    cache.invalidate("exams", f"exams/{exam.id}")
 
     return f"Added new assignment: {exam.name}"
 
 
 @router.get("/", response_model=List[Exam])
-async def get_all_exams(db: Session = Depends(get_db)):
+async def get_all_exams(request: Request, db: Session = Depends(get_db)):
     """
     Retrieves all exams from the database.
 
     Returns:
         List[Exam]: The list of all exams.
     """
+    if cached := cache.lookup("exams", request):
+        return cached
+
     exams = db.query(models.Exam).all()
-    return exams
+    return cache.store("exams", request, exams, List[Exam])
 
 
 @router.get("/{id}", response_model=Exam)
-async def get_exam(id: str, db: Session = Depends(get_db)):
+async def get_exam(id: str, request: Request, db: Session = Depends(get_db)):
     """
     Retrieves a single exam from the database by its id.
 
     Returns:
         Exam: The exam if found.
     """
+    if cached := cache.lookup(f"exams/{id}", request):
+        return cached
+
     exam = db.query(models.Exam).filter(models.Exam.id == id).first()
     if not exam:
         raise HTTPException(
             status_code=404, detail=f"Exam {id} not found")
-    return exam
+    return cache.store(f"exams/{id}", request, exam, Exam)
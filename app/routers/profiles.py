@@ -0,0 +1,36 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+
+from ..profiler import store
+
+
+router = APIRouter(
+    prefix="/admin/profiles",
+    tags=['Admin']
+)
+
+
+@router.get("/")
+async def list_profiles():
+    """
+    Lists captured profiles of slow requests, newest first.
+
+    Returns:
+        list[dict]: The metadata of each capture.
+    """
+    return store.list()
+
+
+@router.get("/{id}")
+async def download_profile(id: str):
+    """
+    Downloads a captured profile, readable with pstats or snakeviz.
+
+    Returns:
+        FileResponse: The `.prof` file.
+    """
+    path = store.path(id)
+    if path is None:
+        raise HTTPException(
+            status_code=404, detail=f"Profile {id} not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{id}.prof")
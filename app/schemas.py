@@ -18,6 +18,7 @@ class SubmissionResponse(BaseModel):
     summary: str
     score: float
     channel: Optional[str]
+    solution_version: Optional[str] = None
 
 
 class Exam(BaseModel):
@@ -1,20 +1,180 @@
+from typing import Callable
 from fastapi import WebSocket
+from sqlalchemy import text
+import psycopg2
+import asyncio
+import logging
+import json
+
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBroker:
+    """In-process pub/sub, for a single worker and for tests."""
+
+    def subscribe(self, handler):
+        self.handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, message: dict):
+        await self.handler(message)
+
+
+class PostgresBroker:
+    """
+    Pub/sub over Postgres LISTEN/NOTIFY, so that every worker receives the
+    events published by any of them and relays them to its own sockets.
+
+    Messages larger than the NOTIFY payload limit are split when their
+    content is a list (e.g. a batch of submissions).
+
+    If the LISTEN connection drops (server restart, failover, idle timeout),
+    it is reopened with exponential backoff. Notifications sent while it is
+    down are not delivered to this worker.
+    """
+    MAX_PAYLOAD = 7900
+    RECONNECT_DELAY = 0.5
+    MAX_RECONNECT_DELAY = 30
+
+    def __init__(self, channel: str = "exam_notifications"):
+        self.channel = channel
+        self.conn = None
+        self.fileno = None
+        self.reconnecting = None
+        self.tasks = set()
+
+    def subscribe(self, handler):
+        self.handler = handler
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        await self.listen()
+
+    async def stop(self):
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+            self.reconnecting = None
+        self.disconnect()
+
+    async def listen(self):
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        conn = await asyncio.to_thread(psycopg2.connect, dsn)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel}")
+        except psycopg2.Error:
+            conn.close()
+            raise
+        self.conn = conn
+        # The descriptor is gone once the connection is closed, keep it to remove the reader
+        self.fileno = conn.fileno()
+        self.loop.add_reader(self.fileno, self.receive)
+
+    def disconnect(self):
+        if self.conn is not None:
+            self.loop.remove_reader(self.fileno)
+            self.conn.close()
+            self.conn = None
+
+    async def reconnect(self):
+        delay = self.RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.listen()
+            except psycopg2.OperationalError as e:
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+                logger.warning("LISTEN %s reconnect failed, retrying in %gs: %s",
+                               self.channel, delay, e)
+            else:
+                logger.info("LISTEN %s reconnected", self.channel)
+                self.reconnecting = None
+                return
+
+    def receive(self):
+        try:
+            self.conn.poll()
+        except psycopg2.OperationalError as e:
+            logger.warning("LISTEN %s connection lost: %s", self.channel, e)
+            self.disconnect()
+            self.reconnecting = self.loop.create_task(self.reconnect())
+            return
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            task = self.loop.create_task(self.handler(json.loads(notify.payload)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def split(self, message: dict) -> list[str]:
+        payload = json.dumps(message)
+        content = message.get("content")
+        if len(payload) <= self.MAX_PAYLOAD or not isinstance(content, list) or len(content) < 2:
+            return [payload]
+        half = len(content) // 2
+        return (self.split({**message, "content": content[:half]})
+                + self.split({**message, "content": content[half:]}))
+
+    def notify(self, payloads: list[str]):
+        with engine.begin() as conn:
+            for payload in payloads:
+                conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                             {"channel": self.channel, "payload": payload})
+
+    async def publish(self, message: dict):
+        await asyncio.to_thread(self.notify, self.split(message))
 
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, broker: LocalBroker | PostgresBroker):
         self.active_connections: list[WebSocket] = []
+        # Message types handled by the workers themselves, never sent to clients
+        self.handlers: dict[str, Callable[[object], None]] = {}
+        self.broker = broker
+        self.broker.subscribe(self.send)
+
+    def on(self, message_type: str, handler: Callable[[object], None]):
+        """Handle messages of a type on every worker, with their content."""
+        self.handlers[message_type] = handler
+
+    async def start(self):
+        await self.broker.start()
+
+    async def stop(self):
+        await self.broker.stop()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+        """Publish a message to the clients connected to every worker."""
+        await self.broker.publish(message)
+
+    async def send(self, message: dict):
+        """Send a message to the clients connected to this worker."""
+        handler = self.handlers.get(message.get("type"))
+        if handler is not None:
+            handler(message.get("content"))
+            return
+        for connection in list(self.active_connections):
+            try:
+                await connection.send_json(message)
+            except Exception:
+                self.disconnect(connection)
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(
+    PostgresBroker() if engine.dialect.name == "postgresql" else LocalBroker()
+)
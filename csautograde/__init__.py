@@ -1 +1 @@
-from .main import M11Marker, M12Marker, M21Marker, M31Marker, create_summary
+from .main import M11Marker, M12Marker, M12SQLMarker, M21Marker, M31Marker, create_summary
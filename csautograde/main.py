@@ -1,10 +1,13 @@
 from abc import ABC, abstractmethod
 from .utils import Utils
+from .registry import registry
+from .replica import SQLReplica, get_replica
 import requests
-import sqlite3
+import copy
 import pandas as pd
-import json
-import yaml
+import numpy as np
+import time
+import os
 
 
 class ExamMarkerBase(ABC):
@@ -14,13 +17,21 @@ class ExamMarkerBase(ABC):
     Attributes:
         solution_url (str): The URL of the solutions JSON file
         solutions (dict): A dictionary mapping question numbers to solutions
+        solution_version (str): Version of the solution files used for grading
         summary (dict): A summary of student's performance
+        timings (dict): Seconds spent marking each question
     """
 
     def __init__(self, solution_url: str):
         self.solution_url = solution_url
-        self.solutions = self.get_solutions()
+        self.solutions, self.solution_version = self.get_solutions()
+        self.reset()
+
+    def reset(self):
+        """Clear the summary and timings so the marker can grade another submission."""
         self.summary = self.initialize_summary()
+        self.timings = {}
+        self.last_marked_at = time.perf_counter()
 
     def initialize_summary(self) -> dict:
         return {
@@ -31,9 +42,19 @@ class ExamMarkerBase(ABC):
             'Issue': [],
         }
 
-    def get_solutions(self) -> dict:
-        with open(self.solution_url, 'r') as f:
-            return yaml.safe_load(f)
+    def get_solutions(self) -> tuple[dict, str]:
+        # The registry shares parsed data across markers, keep a private copy
+        solutions, version = registry.get(self.solution_url)
+        return copy.deepcopy(solutions), version
+
+    @classmethod
+    def solution_files(cls) -> list[str]:
+        return [cls.SOLUTION_URL]
+
+    @classmethod
+    def get_solution_version(cls) -> str:
+        """Version of the solution files, changes whenever a solution is edited."""
+        return "-".join(registry.get_version(path) for path in cls.solution_files())
 
     @abstractmethod
     def mark_submission(self, submission: list):
@@ -56,6 +77,10 @@ class ExamMarkerBase(ABC):
         if issue:
             self.summary['Issue'].append((question_number, issue))
 
+        now = time.perf_counter()
+        self.timings[question_number] = now - self.last_marked_at
+        self.last_marked_at = now
+
     def calculate_score(self, question_number: int):
         for question_range, score in self.QUESTION_SCORES.items():
             if question_number in question_range:
@@ -95,7 +120,63 @@ class ExamMarkerBase(ABC):
         print(f"FINAL SCORE: {final_score:g}/100")
 
 
-class M11Marker(ExamMarkerBase):
+class SQLExamMarker(ExamMarkerBase):
+    """
+    Base class for exams with SQL questions
+
+    SQL answers are graded on an in-memory, read-only replica of the exam
+    database, loaded once per process. Other answers are compared with the
+    solution, which may be a list of accepted answers.
+
+    Attributes:
+        DATABASE (str): Path of the exam database file
+        DATABASE_URL (str | None): Where to download the database from if it is missing
+        SQL_QUESTIONS (range): Question numbers answered with a SQL query
+    """
+    DATABASE: str
+    DATABASE_URL: str | None = None
+    SQL_QUESTIONS: range = range(0)
+
+    def __init__(self):
+        super().__init__(self.SOLUTION_URL)
+        self.replica = self.get_replica()
+
+    @classmethod
+    def get_replica(cls) -> SQLReplica:
+        if not os.path.exists(cls.DATABASE) and cls.DATABASE_URL:
+            response = requests.get(cls.DATABASE_URL)
+            with open(cls.DATABASE, "wb") as file:
+                file.write(response.content)
+        return get_replica(cls.DATABASE)
+
+    def check_submission(self, submission: list, start_index=1):
+        with self.replica.connection() as conn:
+            for i, answer in enumerate(submission, start_index):
+                solution = self.solutions.get(i)
+                correct = None
+                issue = None
+
+                if answer:
+                    if i in self.SQL_QUESTIONS:
+                        correct, issue = Utils.check_sql(
+                            answer, solution, i, conn)
+                    elif isinstance(solution, list):
+                        correct = answer in solution
+                    else:
+                        correct = answer == solution
+
+                self.update_summary(i, correct, issue)
+
+    def mark_submission(self, submission: list) -> dict:
+        self.check_submission(submission)
+        return self.summary
+
+
+class M11Marker(SQLExamMarker):
+    SOLUTION_URL = "solutions/M11.yml"
+    DATABASE = "northwind.db"
+    DATABASE_URL = 'https://github.com/nauqh/csautograde/blob/master/northwind.db?raw=true'
+    SQL_QUESTIONS = range(6, 21)
     QUESTION_SCORES = {
         range(1, 6): 2,
         range(6, 10): 3,
@@ -104,37 +185,31 @@ class M11Marker(ExamMarkerBase):
     }
 
     def __init__(self):
-        super().__init__("solutions/M11.yml")
+        super().__init__()
         self.exam_name = "M1.1"
-        response = requests.get(
-            'https://github.com/nauqh/csautograde/blob/master/northwind.db?raw=true')
-        with open("northwind.db", "wb") as file:
-            file.write(response.content)
-
-        self.conn = sqlite3.connect("northwind.db")
-
-    def check_submission(self, submission: list, is_sql: bool = False, start_index=1):
-        for i, answer in enumerate(submission, start_index):
-            solution = self.solutions.get(i)
-            correct = None
-            issue = None
 
-            if answer:
-                if is_sql:
-                    correct, issue = Utils.check_sql(
-                        answer, solution, i, self.conn)
-                else:
-                    correct = answer == solution
 
-            self.update_summary(i, correct, None)
+class M12SQLMarker(SQLExamMarker):
+    """
+    SQL questions on the Chinook database. Not gradable through the API yet:
+    the rubric below is provisional until the course owners supply the real one.
+    """
+    SOLUTION_URL = "solutions/M12SQL.yml"
+    DATABASE = "chinook.db"
+    DATABASE_URL = 'https://github.com/nauqh/csautograde/blob/master/chinook.db?raw=true'
+    SQL_QUESTIONS = range(1, 13)
+    QUESTION_SCORES = {
+        range(1, 6): 6,
+        range(6, 13): 10,
+    }
 
-    def mark_submission(self, submission: list) -> dict:
-        self.check_submission(submission[:5], is_sql=False, start_index=1)
-        self.check_submission(submission[5:], is_sql=True, start_index=6)
-        return self.summary
+    def __init__(self):
+        super().__init__()
+        self.exam_name = "M1.2 SQL"
 
 
 class M12Marker(ExamMarkerBase):
+    SOLUTION_URL = "solutions/M12.yml"
     QUESTION_SCORES = {
         range(1, 6): 5,
         range(6, 7): 10,
@@ -146,7 +221,7 @@ class M12Marker(ExamMarkerBase):
     }
 
     def __init__(self):
-        super().__init__("solutions/M12.yml")
+        super().__init__(self.SOLUTION_URL)
         self.exam_name = "M1.2"
 
     def check_submission(self, submission: list, start_index=1):
@@ -168,6 +243,7 @@ class M12Marker(ExamMarkerBase):
 
 
 class M31Marker(ExamMarkerBase):
+    SOLUTION_URL = "solutions/M31.yml"
     QUESTION_SCORES = {
         range(1, 13): 5,
         range(13, 15): 15,
@@ -175,13 +251,16 @@ class M31Marker(ExamMarkerBase):
     }
 
     def __init__(self):
-        super().__init__("solutions/M31.yml")
+        super().__init__(self.SOLUTION_URL)
         self.exam_name = "M3.1"
         df = pd.read_csv(
             'https://raw.githubusercontent.com/anhquan0412/dataset/main/Salaries.csv')
         df.drop(columns=['Notes', 'Status', 'Agency'], inplace=True)
         df['JobTitle'] = df['JobTitle'].str.title()
-        self.df = df
+        self.df = Utils.freeze_df(df)
+        # Built once; each question evaluates in a shallow copy of it, so an
+        # assignment expression like `(pd := None)` cannot leak into other questions
+        self.eval_globals = Utils.answer_globals(pd=pd, np=np)
 
     def check_submission(self, submission: list, start_index: int, is_expression: bool = False):
         for i, answer in enumerate(submission, start_index):
@@ -191,10 +270,13 @@ class M31Marker(ExamMarkerBase):
 
             if answer:
                 if is_expression:
-                    global_dict = globals().copy()
-                    global_dict['df'] = self.df
+                    # Shallow copy shares the read-only buffers, so column assignment
+                    # or inplace ops only ever touch this view, never self.df
+                    df_view = self.df.copy(deep=False)
                     correct, issue = Utils.check_expression(
-                        answer, solution, i, global_dict)
+                        answer, solution, i, {**self.eval_globals, 'df': df_view})
+                    if Utils.is_df_mutated(df_view, self.df) or (issue and 'read-only' in issue):
+                        issue = f"Q{i}: Submission must not modify df"
                 else:
                     correct = answer == solution
 
@@ -209,6 +291,8 @@ class M31Marker(ExamMarkerBase):
 
 
 class M21Marker(ExamMarkerBase):
+    SOLUTION_URL = "solutions/M21.yml"
+    TEST_CASES_URL = "solutions/M21_test_cases.json"
     QUESTION_SCORES = {
         range(1, 9): 4,
         range(9, 13): 12,
@@ -216,14 +300,26 @@ class M21Marker(ExamMarkerBase):
     }
 
     def __init__(self):
-        super().__init__("solutions/M21.yml")
+        super().__init__(self.SOLUTION_URL)
         self.exam_name = "M2.1"
-        self.test_cases = self.get_test_cases()
+        self.test_cases, test_cases_version = self.get_test_cases()
+        self.solution_version = f"{self.solution_version}-{test_cases_version}"
+
+    def reset(self):
+        """Also rebuild the namespace, so definitions never leak between submissions."""
+        super().reset()
+        # Functions are defined in a namespace private to this marker, so markers
+        # grading in different threads never overwrite each other's definitions
+        self.exec_globals = Utils.answer_globals()
+
+    @classmethod
+    def solution_files(cls) -> list[str]:
+        return [cls.SOLUTION_URL, cls.TEST_CASES_URL]
 
-    def get_test_cases(self) -> dict:
-        with open("solutions/M21_test_cases.json", "r") as f:
-            test_cases = json.load(f)
-        return test_cases
+    def get_test_cases(self) -> tuple[dict, str]:
+        # Test cases are passed to learner code, which may mutate them in place
+        test_cases, version = registry.get(self.TEST_CASES_URL)
+        return copy.deepcopy(test_cases), version
 
     def check_submission(self, submission: list, start_index: int, is_function: bool = False):
         for i, answer in enumerate(submission, start_index):
@@ -235,7 +331,7 @@ class M21Marker(ExamMarkerBase):
             if answer:
                 if is_function:
                     correct, issue = Utils.check_function(
-                        answer, solution, globals(), i, tests)
+                        answer, solution, self.exec_globals, i, tests)
                 else:
                     if isinstance(solution, list):
                         answer = answer.split(",")
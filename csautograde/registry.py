@@ -0,0 +1,65 @@
+from threading import Lock
+import hashlib
+import json
+import os
+import yaml
+
+
+class SolutionRegistry:
+    """
+    Registry of solution and test case files, versioned by content hash.
+
+    Every lookup stats the file, which is cheap; the file is only read again
+    when its mtime or size changed, and only parsed again when its content
+    hash changed. A new version replaces the old one in a single assignment,
+    so readers always get a matching (data, version) pair and fixed solutions
+    are picked up without restarting the process.
+
+    Attributes:
+        entries (dict): Maps a path to its (stat key, version, data)
+    """
+
+    def __init__(self):
+        self.entries: dict[str, tuple[tuple, str, object]] = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def parse(path: str, content: bytes):
+        if path.endswith('.json'):
+            return json.loads(content)
+        return yaml.safe_load(content)
+
+    def get(self, path: str) -> tuple[object, str]:
+        """
+        Get the parsed content of a file and its version.
+
+        Returns:
+            (data, version) where version is a short hash of the file content
+        """
+        stat = os.stat(path)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == stat_key:
+            return entry[2], entry[1]
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stat_key:
+                return entry[2], entry[1]
+
+            with open(path, 'rb') as f:
+                content = f.read()
+            version = hashlib.sha256(content).hexdigest()[:12]
+            if entry is not None and entry[1] == version:
+                # Touched but unchanged, keep the parsed data
+                data = entry[2]
+            else:
+                data = self.parse(path, content)
+            self.entries[path] = (stat_key, version, data)
+            return data, version
+
+    def get_version(self, path: str) -> str:
+        return self.get(path)[1]
+
+
+registry = SolutionRegistry()
@@ -0,0 +1,72 @@
+from contextlib import contextmanager
+from threading import Lock
+import sqlite3
+import queue
+import os
+
+
+class SQLReplica:
+    """
+    In-memory, read-only replica of an SQLite exam database.
+
+    The database file is copied into memory once with the backup API, then
+    queries run on a small pool of connections to that copy. Each connection
+    is checked out by one thread at a time and marked query-only, so grading
+    never touches the file on disk and never contends on its locks.
+
+    Attributes:
+        path (str): The database file the replica was loaded from
+        pool_size (int): Maximum number of connections to the replica
+    """
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = os.path.abspath(path)
+        self.pool_size = pool_size
+        # Connections to the same name on the memdb VFS share one in-memory database
+        self.uri = f"file:{self.path}?vfs=memdb"
+        self.pool: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self.created = 0
+        self.lock = Lock()
+
+        # The replica lives as long as at least one connection to it is open
+        self.master = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        source = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            source.backup(self.master)
+        finally:
+            source.close()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check out a read-only connection, waiting if all of them are in use."""
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_create = self.created < self.pool_size
+                if can_create:
+                    self.created += 1
+            conn = self.connect() if can_create else self.pool.get()
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            self.pool.put(conn)
+
+
+_replicas: dict[str, SQLReplica] = {}
+_replicas_lock = Lock()
+
+
+def get_replica(path: str) -> SQLReplica:
+    """Get the replica of a database, loading it on first use in this process."""
+    key = os.path.abspath(path)
+    with _replicas_lock:
+        if key not in _replicas:
+            _replicas[key] = SQLReplica(path)
+        return _replicas[key]
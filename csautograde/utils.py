@@ -1,10 +1,16 @@
 import pandas as pd
-from functools import partial
+from functools import partial, lru_cache
 import pandas as pd
 import numpy as np
 import textwrap
+import logging
+import builtins
+import sqlite3
+import copy
 import ast
 
+logger = logging.getLogger(__name__)
+
 
 class Utils():
 
@@ -12,6 +18,43 @@ class Utils():
     is_close = partial(np.isclose, atol=1e-6, equal_nan=True)
     DEBUG = True
 
+    # Constructs rejected by the static pre-check, before any code is executed
+    FORBIDDEN_CALLS = {'open', 'exec', 'eval', 'compile', '__import__',
+                       'input', 'breakpoint', 'globals', 'locals', 'vars',
+                       'getattr', 'setattr', 'delattr'}
+    FORBIDDEN_ATTRIBUTES = {'__globals__', '__builtins__', '__code__',
+                            '__subclasses__', '__bases__', '__mro__',
+                            # File I/O reachable through pandas and numpy
+                            'to_csv', 'to_excel', 'to_json', 'to_parquet', 'to_pickle',
+                            'to_sql', 'to_hdf', 'to_feather', 'to_orc', 'to_stata',
+                            'tofile', 'load', 'save', 'savez', 'savetxt', 'loadtxt',
+                            'genfromtxt', 'fromfile', 'memmap'}
+    # Builtins available to answers; everything else (open, getattr, __import__, ...)
+    # is simply not defined in the namespace answers run in
+    SAFE_BUILTINS = {
+        'abs', 'all', 'any', 'bin', 'bool', 'callable', 'chr', 'complex', 'dict',
+        'divmod', 'enumerate', 'filter', 'float', 'format', 'frozenset', 'hash',
+        'hex', 'int', 'isinstance', 'issubclass', 'iter', 'len', 'list', 'map',
+        'max', 'min', 'next', 'object', 'oct', 'ord', 'pow', 'print', 'range',
+        'repr', 'reversed', 'round', 'set', 'slice', 'sorted', 'str', 'sum',
+        'super', 'tuple', 'zip', '__build_class__',
+        'Exception', 'ArithmeticError', 'AssertionError', 'AttributeError',
+        'IndexError', 'KeyError', 'LookupError', 'NameError', 'StopIteration',
+        'TypeError', 'ValueError', 'ZeroDivisionError',
+    }
+    # Rows fetched per round trip when streaming a learner's SQL result
+    SQL_CHUNK_SIZE = 1000
+    # SQLite VM instructions a flagged query may run (about a second), checked
+    # every SQL_STEP_INTERVAL instructions
+    SQL_STEP_BUDGET = 50_000_000
+    SQL_STEP_INTERVAL = 10_000
+    # (database file, solution query) -> (column names, rows)
+    _solution_results = {}
+
+    # SQLite authorizer actions a read-only query may perform
+    READ_ONLY_SQL_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ,
+                             sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
     @classmethod
     def printt(cls, msg):
         if cls.DEBUG:
@@ -90,32 +133,195 @@ class Utils():
         return a_val == b_val
 
     @classmethod
-    def check_expression(cls, submission, solution, q_index, global_dict):
+    def freeze_df(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Mark the NumPy buffers backing a DataFrame as read-only, in place.
+        Any attempt to write into them raises a ValueError instead of silently
+        corrupting the shared data.
+        """
+        for arr in df._mgr.arrays:
+            buffer = cls._numpy_buffer(arr)
+            if buffer is not None:
+                buffer.flags.writeable = False
+        return df
+
+    @classmethod
+    def is_df_mutated(cls, view: pd.DataFrame, base: pd.DataFrame) -> bool:
+        """
+        Check whether a shallow copy of `base` has been modified (column assignment,
+        inplace operations, reindexing). Only compares metadata and buffer bounds,
+        so it stays cheap regardless of the number of rows.
+        """
+        if view.shape != base.shape:
+            return True
+        if not (view.columns.equals(base.columns) and view.index.equals(base.index)):
+            return True
+        # Compare column by column: replacing a column splits its block and appends
+        # the new one at the end, so blocks no longer line up by position
+        for i in range(base.shape[1]):
+            if not cls._shares_data(view.iloc[:, i].array, base.iloc[:, i].array):
+                return True
+        return False
+
+    @classmethod
+    def _shares_data(cls, a_arr, b_arr) -> bool:
+        a_buf, b_buf = cls._numpy_buffer(a_arr), cls._numpy_buffer(b_arr)
+        if a_buf is not None or b_buf is not None:
+            return a_buf is not None and b_buf is not None and np.may_share_memory(a_buf, b_buf)
+        # Arrow-backed arrays (e.g. the default string dtype) are immutable, a
+        # modified column is a new array with new buffers
+        a_pa, b_pa = getattr(a_arr, '_pa_array', None), getattr(b_arr, '_pa_array', None)
+        if a_pa is not None or b_pa is not None:
+            return a_pa is not None and b_pa is not None \
+                and cls._arrow_addresses(a_pa) == cls._arrow_addresses(b_pa)
+        return True
+
+    @staticmethod
+    def _arrow_addresses(chunked) -> list[int]:
+        return [buffer.address for chunk in chunked.chunks for buffer in chunk.buffers() if buffer]
+
+    @staticmethod
+    def _numpy_buffer(arr) -> np.ndarray | None:
+        # NumPy-backed extension arrays (e.g. StringArray) keep their data in
+        # `_ndarray`, categoricals keep their codes in `_codes`
+        buffer = getattr(arr, '_ndarray', getattr(arr, '_codes', arr))
+        return buffer if isinstance(buffer, np.ndarray) else None
+
+    @classmethod
+    def answer_globals(cls, **names) -> dict:
+        """
+        Build a minimal namespace to run answers in: the safe builtins and the
+        given `names` (e.g. pd, np). Nothing of the grader's own modules is
+        reachable from it, so answers cannot touch files, the network or grading.
+        """
+        safe_builtins = {name: getattr(builtins, name) for name in cls.SAFE_BUILTINS}
+        return {'__builtins__': safe_builtins, '__name__': '__answer__', **names}
+
+    @classmethod
+    def find_forbidden(cls, tree: ast.AST) -> str | None:
+        """
+        Walk an AST and return a description of the first forbidden construct:
+        imports, file/network access through builtins, pandas or numpy, dunder
+        introspection or unbounded `while True` loops. Returns None if the code
+        looks safe to run.
+        """
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
+                return "Imports are not allowed"
+            if isinstance(node, ast.Name) and node.id.startswith('__') and node.id.endswith('__'):
+                return f"Accessing {node.id} is not allowed"
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                    and node.func.id in cls.FORBIDDEN_CALLS:
+                return f"Calling {node.func.id}() is not allowed"
+            if isinstance(node, ast.Attribute) and (
+                    node.attr in cls.FORBIDDEN_ATTRIBUTES or node.attr.startswith('read_')):
+                return f"Accessing {node.attr} is not allowed"
+            if isinstance(node, ast.While) and isinstance(node.test, ast.Constant) \
+                    and node.test.value and not any(
+                        isinstance(n, (ast.Break, ast.Return)) for n in ast.walk(node)):
+                return "Infinite while loop is not allowed"
+        return None
+
+    @classmethod
+    def precheck_expression(cls, submission, q_index):
+        """
+        Parse an expression answer once and compile it without evaluating it.
+        An assignment (`x = <expr>`) is accepted but flagged as wrong format.
+
+        Returns:
+            ((code, wrong_format), None) if the answer can be evaluated
+            (None, issue) if the answer is rejected
+        """
         if not isinstance(submission, str):
-            cls.printt("Your expression answer must be a string")
-            return 'INVALID'
+            return None, f'Q{q_index}: Your expression answer must be a string'
 
         try:
-            def is_assignment(code):
-                try:
-                    tree = ast.parse(code)
-                    return isinstance(tree.body[0], ast.Assign)
-                except Exception:
-                    return False
-
-            # If it's an assignment, extract the right-hand side of the assignment (the expression)
-            if is_assignment(submission):
-                submission_expr = submission.split('=', 1)[1].strip()
-            else:
-                submission_expr = submission.strip()
+            tree = ast.parse(textwrap.dedent(submission).strip())
+        except SyntaxError as e:
+            return None, f'Q{q_index}: Syntax error at line {e.lineno}: {e.msg}'
+
+        if len(tree.body) != 1 or not isinstance(tree.body[0], (ast.Expr, ast.Assign)):
+            return None, f'Q{q_index}: Submission must be a single expression'
+
+        forbidden = cls.find_forbidden(tree)
+        if forbidden:
+            return None, f'Q{q_index}: {forbidden}'
+
+        statement = tree.body[0]
+        expression = ast.Expression(body=statement.value)
+        code = compile(expression, f'<Q{q_index}>', 'eval')
+        return (code, isinstance(statement, ast.Assign)), None
+
+    @classmethod
+    def precheck_function(cls, submission, q_index, n_args=None, func_name=None):
+        """
+        Parse a function answer once and compile it without executing it.
+        The graded function is the one named `func_name`, or else the last
+        top-level definition, since helpers are usually defined first. Checks it
+        can be called with `n_args` positional arguments. Top-level code other
+        than function definitions before it is flagged as wrong format; code
+        after it, such as a test call, is allowed.
+
+        Returns:
+            ((code, func_name, wrong_format), None) if the answer can be run
+            (None, issue) if the answer is rejected
+        """
+        if not isinstance(submission, str):
+            return None, f'Q{q_index}: Your function answer must be a string'
+
+        try:
+            tree = ast.parse(textwrap.dedent(submission))
+        except SyntaxError as e:
+            return None, f'Q{q_index}: Syntax error at line {e.lineno}: {e.msg}'
+
+        functions = [node for node in tree.body if isinstance(node, ast.FunctionDef)]
+        if not functions:
+            return None, f'Q{q_index}: Submission must define a function'
+
+        forbidden = cls.find_forbidden(tree)
+        if forbidden:
+            return None, f'Q{q_index}: {forbidden}'
+
+        func = next((node for node in functions if node.name == func_name), functions[-1])
+        if n_args is not None:
+            args = func.args
+            positional = len(args.posonlyargs) + len(args.args)
+            required = positional - len(args.defaults)
+            if n_args < required or (n_args > positional and args.vararg is None):
+                return None, f'Q{q_index}: Function {func.name}() must accept {n_args} argument(s)'
+
+        before = tree.body[:tree.body.index(func)]
+        wrong_format = any(not isinstance(node, ast.FunctionDef) for node in before)
+        code = compile(tree, f'<Q{q_index}>', 'exec')
+        return (code, func.name, wrong_format), None
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def compile_solution(solution: str, mode: str):
+        """Compile a solution once; returns the code object and, for functions, its name."""
+        tree = ast.parse(textwrap.dedent(solution).strip())
+        if mode == 'eval':
+            return compile(ast.Expression(body=tree.body[-1].value), '<solution>', 'eval'), None
+        func_name = next(node.name for node in tree.body if isinstance(node, ast.FunctionDef))
+        return compile(tree, '<solution>', 'exec'), func_name
+
+    @classmethod
+    def check_expression(cls, submission, solution, q_index, global_dict):
+        precheck, issue = cls.precheck_expression(submission, q_index)
+        if issue:
+            return False, issue
+        code_sub, wrong_format = precheck
+
+        try:
+            code_sol, _ = cls.compile_solution(solution, 'eval')
 
             # Evaluate both the submission and the solution expressions in the provided global context
-            result_sol = eval(textwrap.dedent(solution), global_dict)
-            result_sub = eval(textwrap.dedent(submission_expr), global_dict)
+            result_sol = eval(code_sol, global_dict)
+            result_sub = eval(code_sub, global_dict)
 
             # Check if the results are closely equal using the existing equality checks
             if cls.is_equal(result_sol, result_sub):
-                if is_assignment(submission):
+                if wrong_format:
                     return "Partial", f"Q{q_index}: Submission is in wrong format"
                 return True, None
             else:
@@ -128,20 +334,28 @@ class Utils():
     @classmethod
     def check_function(cls, submission, solution, global_dict, q_index, tests=None):
         try:
-            solution = textwrap.dedent(solution)
-            exec(submission, global_dict)
-            exec(solution, global_dict)
+            code_sol, func_name_sol = cls.compile_solution(solution, 'exec')
+        except Exception as e:
+            return False, f'Q{q_index}: {e}'
 
-            have_other_code = submission[:submission.find('def')].strip() != ""
-            submission = submission[submission.find('def'):]
-            func_name_sub = submission.split('(')[0][4:]
-            func_name_sol = solution.split('(')[0][4:].strip()
+        n_args = len(tests[0]) if tests else None
+        precheck, issue = cls.precheck_function(
+            submission, q_index, n_args, func_name_sol.removesuffix('_sol'))
+        if issue:
+            return False, issue
+        code_sub, func_name_sub, have_other_code = precheck
+
+        try:
+            exec(code_sub, global_dict)
+            exec(code_sol, global_dict)
 
             test_passed = 0
 
             for test in tests:
-                result_sub = global_dict[func_name_sub](*test)
-                result_sol = global_dict[func_name_sol](*test)
+                # Each call gets its own arguments, a function mutating them must
+                # not change the test case for the solution or later submissions
+                result_sub = global_dict[func_name_sub](*copy.deepcopy(test))
+                result_sol = global_dict[func_name_sol](*copy.deepcopy(test))
 
                 if not cls.is_equal(result_sub, result_sol):
                     issue = f'Q{q_index}: {test} \nExpected output: {result_sol} \nYour output: {result_sub}'
@@ -162,6 +376,107 @@ class Utils():
             issue = f'Q{q_index}: {e}'
             return False, issue
 
+    @classmethod
+    def _read_only_authorizer(cls, action, *args):
+        return sqlite3.SQLITE_OK if action in cls.READ_ONLY_SQL_ACTIONS else sqlite3.SQLITE_DENY
+
+    @classmethod
+    def precheck_sql(cls, query, q_index, connection):
+        """
+        Prepare a query with EXPLAIN and EXPLAIN QUERY PLAN without running it.
+        Rejects statements that are not read-only. Plans that fully scan several
+        tables in the same loop are only flagged: the plan shows no usable index,
+        but the query may still have a join predicate (e.g. on an expression or
+        an inequality), or be a small CROSS JOIN on purpose.
+
+        Returns:
+            ((n_columns, warning), None) if the query can run, warning may be None
+            (None, issue) if the query is rejected
+        """
+        connection.set_authorizer(cls._read_only_authorizer)
+        try:
+            plan = connection.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+            program = connection.execute(f"EXPLAIN {query}").fetchall()
+        except sqlite3.DatabaseError as e:
+            if 'not authorized' in str(e):
+                return None, f'Q{q_index}: Only read-only SELECT queries are allowed'
+            return None, f'Q{q_index}: {e}'
+        finally:
+            connection.set_authorizer(None)
+
+        # Subqueries and CTEs are materialized first; scanning them is not a table scan
+        subqueries = {detail.split(' ', 1)[1] for _, _, _, detail in plan
+                      if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+        scans = {}
+        for _, parent, _, detail in plan:
+            if not detail.startswith('SCAN ') or detail == 'SCAN CONSTANT ROW':
+                continue
+            table = detail.split(' ')[1]
+            if table not in subqueries:
+                scans.setdefault(parent, []).append(table)
+        warning = next(
+            (f'Q{q_index}: Query scans {", ".join(tables)} in full for every row, '
+             f'check the join condition' for tables in scans.values() if len(tables) > 1),
+            None
+        )
+
+        # ResultRow's p2 operand is the number of columns the statement returns
+        n_columns = next((p2 for _, opcode, _, p2, *_ in program if opcode == 'ResultRow'), 0)
+        return (n_columns, warning), None
+
+    @classmethod
+    def fetch_solution(cls, solution, connection) -> tuple[list, list]:
+        """
+        Run a solution query and return its column names and rows. Results are
+        cached per database file, since solutions never change between submissions.
+        """
+        database = connection.execute("PRAGMA database_list").fetchone()[2]
+        key = (database, solution)
+        if database and key in cls._solution_results:
+            return cls._solution_results[key]
+
+        cursor = connection.execute(solution)
+        result = ([col[0] for col in cursor.description], cursor.fetchall())
+        if database:
+            cls._solution_results[key] = result
+        return result
+
+    @classmethod
+    def is_row_equal(cls, a_row: tuple, b_row: tuple) -> bool:
+        """
+        Check whether two result rows are equal, with numbers compared using `is_close`.
+        """
+        if a_row == b_row:
+            return True
+        for a_val, b_val in zip(a_row, b_row):
+            if a_val == b_val:
+                continue
+            if isinstance(a_val, (int, float)) and isinstance(b_val, (int, float)) \
+                    and cls.is_close(a_val, b_val):
+                continue
+            return False
+        return True
+
+    @classmethod
+    def set_step_budget(cls, connection, budget: int | None):
+        """
+        Abort the statements of a connection once they ran `budget` SQLite VM
+        instructions, the statement then raises an 'interrupted' OperationalError.
+        A budget of None removes the limit.
+        """
+        if budget is None:
+            connection.set_progress_handler(None, 0)
+            return
+
+        steps = 0
+
+        def handler():
+            nonlocal steps
+            steps += cls.SQL_STEP_INTERVAL
+            return steps > budget
+
+        connection.set_progress_handler(handler, cls.SQL_STEP_INTERVAL)
+
     @classmethod
     def check_sql(cls, answer, solution, q_index, connection=None):
         if not connection:
@@ -172,13 +487,53 @@ class Utils():
             cls.printt("Your SQL answer must be a string")
             return 'INVALID'
 
+        precheck, issue = cls.precheck_sql(answer, q_index, connection)
+        if issue:
+            return False, issue
+        n_cols_sub, warning = precheck
+
+        precheck_sol, issue_sol = cls.precheck_sql(solution, q_index, connection)
+        if issue_sol:
+            # A broken solution must not be blamed on the learner; compare by running both
+            logger.error("Solution for Q%s fails the SQL pre-check: %s", q_index, issue_sol)
+        elif n_cols_sub != precheck_sol[0]:
+            return False, f'Q{q_index}: Expected {precheck_sol[0]} column(s), your query returns {n_cols_sub}'
+
         try:
-            df_sub = pd.read_sql_query(answer, connection)
-            df_sol = pd.read_sql_query(solution, connection)
-            if not cls.is_df_equal(df_sub, df_sol, same_col_name=False):
-                issue = f'Q{q_index}:\nExpected output:\n {df_sol} \nYour output:\n {df_sub}\n'
-                return False, issue
-            return True, None
+            columns_sol, rows_sol = cls.fetch_solution(solution, connection)
+            if warning:
+                # A flagged plan may run for minutes, even for a one-row result
+                cls.set_step_budget(connection, cls.SQL_STEP_BUDGET)
+            # Stream the learner's result chunk by chunk and stop at the first
+            # mismatch, so a wrong query never materializes its full output
+            cursor = connection.execute(answer)
+            columns_sub = [col[0] for col in cursor.description]
+            n_rows = 0
+            try:
+                while chunk := cursor.fetchmany(cls.SQL_CHUNK_SIZE):
+                    if n_rows + len(chunk) > len(rows_sol):
+                        return False, f'Q{q_index}: Expected {len(rows_sol)} rows, your query returns more'
+
+                    expected = rows_sol[n_rows:n_rows + len(chunk)]
+                    if not all(map(cls.is_row_equal, chunk, expected)):
+                        index = range(n_rows, n_rows + len(chunk))
+                        df_sol = pd.DataFrame(rows_sol, columns=columns_sol)
+                        df_sub = pd.DataFrame(chunk, columns=columns_sub, index=index)
+                        issue = f'Q{q_index}:\nExpected output:\n {df_sol} \nYour output:\n {df_sub}\n'
+                        return False, issue
+                    n_rows += len(chunk)
+            finally:
+                cursor.close()
+
+            if n_rows != len(rows_sol):
+                return False, f'Q{q_index}: Expected {len(rows_sol)} rows, your query returns {n_rows}'
+            return True, warning
+        except sqlite3.OperationalError as e:
+            if warning and 'interrupted' in str(e):
+                return False, f'{warning}; it was stopped after exceeding the execution budget'
+            return False, f'Q{q_index}: {e}'
         except Exception as e:
             issue = f'Q{q_index}: {e}'
             return False, issue
+        finally:
+            cls.set_step_budget(connection, None)